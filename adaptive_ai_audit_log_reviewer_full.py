@@ -1,9 +1,23 @@
 
+import os
+import json
+import hashlib
+import tempfile
+import joblib
+from joblib import Parallel, delayed
 import streamlit as st
 import pandas as pd
-import difflib
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from rapidfuzz import process, fuzz
+from io import BytesIO
 from sklearn.ensemble import IsolationForest
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import make_pipeline
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+MODEL_PREFIX = os.path.splitext(os.path.basename(__file__))[0]
 
 st.set_page_config(page_title="AI Audit Log Reviewer (Flexible)", layout="wide")
 
@@ -12,57 +26,147 @@ st.write("Upload any format of audit trail (CSV) and let the app auto-map fields
 
 # Auto-column mapping using fuzzy logic
 def auto_map_columns(columns, expected_fields):
+    choices = {col: col.lower() for col in columns}
     mapping = {}
     for expected in expected_fields:
-        closest = difflib.get_close_matches(expected.lower(), [col.lower() for col in columns], n=1, cutoff=0.6)
-        if closest:
-            match = next(col for col in columns if col.lower() == closest[0])
-            mapping[expected] = match
-        else:
-            mapping[expected] = None
+        closest = process.extractOne(expected.lower(), choices, scorer=fuzz.ratio, score_cutoff=60)
+        mapping[expected] = closest[2] if closest else None
     return mapping
 
+# Column as text, with blanks rendered as 'nan' like the original astype(str)
+def as_text(col):
+    return col.astype('string[pyarrow]').fillna('nan')
+
 # Combine mapped fields to form a single text column
 def combine_fields(df, mapping):
     fields = [v for v in mapping.values() if v is not None]
     if not fields:
-        return df.astype(str).agg(' '.join, axis=1)
-    return df[fields].astype(str).agg(' '.join, axis=1)
+        fields = list(df.columns)
+    cols = [as_text(df[v]) for v in fields]
+    combined = cols[0]
+    for col in cols[1:]:
+        combined = combined.str.cat(col, sep=' ', na_rep='nan')
+    return combined
+
+# Read the first rows once per file for the preview and column mapping
+@st.cache_data(show_spinner=False)
+def load_preview(csv_bytes):
+    return pd.read_csv(BytesIO(csv_bytes), nrows=10).convert_dtypes(dtype_backend='pyarrow')
+
+# Load the uploaded CSV once per file, with the given columns read as text
+@st.cache_data(show_spinner=False)
+def load_log(csv_bytes, usecols):
+    options = pa_csv.ConvertOptions(column_types={c: pa.string() for c in usecols},
+                                    include_columns=usecols, strings_can_be_null=True)
+    table = pa_csv.read_csv(BytesIO(csv_bytes), convert_options=options)
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
+
+# Parse the log and build the text column once per file and column mapping
+@st.cache_data(show_spinner=False)
+def prepare_log(csv_bytes, mapping):
+    # Whole rows are shown for anomalies here, so every column is loaded
+    df = load_log(csv_bytes, list(load_preview(csv_bytes).columns))
+
+    df['combined_text'] = combine_fields(df, mapping)
+    return df
+
+# One persisted detector per app and log schema
+def model_path(schema):
+    digest = hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(MODEL_DIR, f"{MODEL_PREFIX}-{digest}.joblib")
+
+# Fit the feature pipeline + Isolation Forest and persist them, with a fingerprint
+# of the log they were fitted on, for later uploads
+def fit_detector(texts, schema, source):
+    tfidf = make_pipeline(HashingVectorizer(n_features=512, alternate_sign=False, binary=True, norm=None, dtype=np.float32), TfidfTransformer())
+    X = tfidf.fit_transform(texts).astype(np.float32, copy=False)
+
+    model = IsolationForest(n_estimators=100, max_samples=min(256, X.shape[0]), contamination=0.05, random_state=42, n_jobs=-1, bootstrap=False)
+    model.fit(X)
+
+    fingerprint = {'schema': schema, 'source': source, 'rows': len(texts)}
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    # Write to a temp file and swap it in, so other sessions never load a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=MODEL_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        joblib.dump((tfidf, model, fingerprint), tmp_path, compress=3)
+        os.replace(tmp_path, model_path(schema))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    load_detector.clear()
+    score_log.clear()
+    return tfidf, model
+
+# Persisted (vectorizer, model, fingerprint) for this schema, or None before the first fit
+@st.cache_resource(show_spinner=False)
+def load_detector(schema):
+    path = model_path(schema)
+    if not os.path.exists(path):
+        return None
+    return joblib.load(path)
+
+# Predict in contiguous row chunks on a thread pool, one chunk per core
+def parallel_predict(model, X):
+    n_jobs = max(1, min(os.cpu_count() or 1, X.shape[0]))
+    bounds = np.linspace(0, X.shape[0], n_jobs + 1, dtype=int)
+    parts = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(model.predict)(X[start:stop]) for start, stop in zip(bounds[:-1], bounds[1:])
+    )
+    return np.concatenate(parts)
+
+# Score the log with the persisted detector (predict only, no refit),
+# once per distinct text and broadcast back to every row
+@st.cache_data(show_spinner=False)
+def score_log(csv_bytes, mapping, schema):
+    tfidf, model, _ = load_detector(schema)
+    codes, unique_texts = pd.factorize(prepare_log(csv_bytes, mapping)['combined_text'], use_na_sentinel=False)
+    X = tfidf.transform(unique_texts).astype(np.float32, copy=False)
+    return parallel_predict(model, X)[codes]
 
 # Upload file
 uploaded_file = st.file_uploader("📂 Upload Audit Log File (.csv)", type="csv")
 
 if uploaded_file:
     try:
-        df = pd.read_csv(uploaded_file)
+        csv_bytes = uploaded_file.getvalue()
+        preview = load_preview(csv_bytes)
         st.subheader("🔍 Raw Log Preview")
-        st.dataframe(df.head(10))
+        st.dataframe(preview, width="stretch")
 
         # Auto-map columns
         expected_fields = ['Timestamp', 'User', 'EventType', 'Message']
-        mapping = auto_map_columns(df.columns, expected_fields)
+        mapping = auto_map_columns(preview.columns, expected_fields)
 
         st.markdown("### 🔁 Auto-Mapped Columns")
         for k, v in mapping.items():
             st.write(f"**{k}** → `{v if v else 'Not Found'}`")
 
-        # Combine fields for NLP
-        df['combined_text'] = combine_fields(df, mapping)
+        # Text column for NLP (cached across reruns)
+        df = prepare_log(csv_bytes, mapping)
 
-        # TF-IDF vectorization (text → numbers)
-        tfidf = TfidfVectorizer(max_features=500)
-        X = tfidf.fit_transform(df['combined_text'])
+        # Reuse the model persisted for this column layout (and mapping); fit it on first use or on refit
+        schema = {'columns': list(preview.columns), 'mapping': mapping}
+        detector = load_detector(schema)
+        refit = st.button("🔁 Refit model on this log")
+        if refit or detector is None:
+            fit_detector(df['combined_text'], schema, uploaded_file.name)
+            detector = load_detector(schema)
 
-        # Isolation Forest for anomaly detection
-        model = IsolationForest(n_estimators=100, contamination=0.05, random_state=42)
-        preds = model.fit_predict(X)
+        fitted = detector[2]
+        if (fitted['source'], fitted['rows']) == (uploaded_file.name, len(df)):
+            st.caption(f"Anomaly scores from the model fitted on this log (`{fitted['source']}`, {fitted['rows']} rows).")
+        else:
+            st.warning(f"Anomaly scores come from the model fitted on `{fitted['source']}` ({fitted['rows']} rows), not on this log. Use Refit to fit on this log.")
+        preds = score_log(csv_bytes, mapping, schema)
         df['AI_Anomaly'] = preds
 
         # Show detected anomalies
         anomalies = df[df['AI_Anomaly'] == -1]
         st.subheader("⚠️ AI-Detected Anomalies")
         if not anomalies.empty:
-            st.dataframe(anomalies.head(10))
+            st.dataframe(anomalies.head(10).convert_dtypes(dtype_backend='pyarrow'), width="stretch")
             st.warning(f"{len(anomalies)} anomalies detected out of {len(df)} entries.")
         else:
             st.success("✅ No anomalies detected.")
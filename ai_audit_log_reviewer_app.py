@@ -12,7 +12,7 @@ uploaded_file = st.file_uploader("📂 Upload CSV File", type="csv")
 
 if uploaded_file is not None:
     try:
-        df = pd.read_csv(uploaded_file)
+        df = pd.read_csv(uploaded_file, engine='pyarrow', dtype_backend='pyarrow')
         st.subheader("🔍 Raw Audit Log Preview")
         st.dataframe(df.head(20))
 
@@ -23,18 +23,21 @@ if uploaded_file is not None:
         # Add example anomaly detection
         anomalies = []
         if 'EventType' in df.columns:
+            event_type = df['EventType'].str.lower()
+
             # Detect override events
-            override_events = df[df['EventType'].str.contains("override", case=False, na=False)]
-            if not override_events.empty:
-                anomalies.append(f"⚠️ Found {len(override_events)} override events.")
+            override_count = event_type.str.contains("override", regex=False, na=False).sum()
+            if override_count:
+                anomalies.append(f"⚠️ Found {override_count} override events.")
 
             # Detect logins outside business hours
             if 'Timestamp' in df.columns:
                 df['Hour'] = df['Timestamp'].dt.hour
-                odd_logins = df[(df['EventType'].str.contains("login", case=False, na=False)) &
-                                ((df['Hour'] < 6) | (df['Hour'] > 20))]
-                if not odd_logins.empty:
-                    anomalies.append(f"⏰ Detected {len(odd_logins)} logins outside business hours.")
+                is_login = event_type.str.contains("login", regex=False, na=False)
+                odd_hours = ((df['Hour'] < 6) | (df['Hour'] > 20)).fillna(False)
+                odd_login_count = (is_login & odd_hours).sum()
+                if odd_login_count:
+                    anomalies.append(f"⏰ Detected {odd_login_count} logins outside business hours.")
 
         # Display anomaly summary
         st.subheader("⚠️ Anomaly Summary")
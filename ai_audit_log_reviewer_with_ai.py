@@ -1,37 +1,138 @@
 
+import os
+import json
+import hashlib
+import tempfile
+import joblib
+from joblib import Parallel, delayed
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 from sklearn.ensemble import IsolationForest
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import make_pipeline
 from datetime import datetime
+from io import BytesIO
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+MODEL_PREFIX = os.path.splitext(os.path.basename(__file__))[0]
 
 st.set_page_config(page_title="AI Audit Log Reviewer", layout="wide")
 
 st.title("🛡️ AI-Powered Audit Log Reviewer")
 st.write("Upload a system audit log (.csv) to review and analyze compliance anomalies using AI-based detection.")
 
+# Load the uploaded CSV once per file, every column read as text
+@st.cache_data(show_spinner=False)
+def load_log(csv_bytes):
+    columns = pd.read_csv(BytesIO(csv_bytes), nrows=0).columns
+    options = pa_csv.ConvertOptions(column_types={c: pa.string() for c in columns}, strings_can_be_null=True)
+    table = pa_csv.read_csv(BytesIO(csv_bytes), convert_options=options)
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
+
+# Parse the log and build the text column once per uploaded file
+@st.cache_data(show_spinner=False)
+def prepare_log(csv_bytes):
+    df = load_log(csv_bytes)
+
+    # Normalize timestamps
+    if 'Timestamp' in df.columns:
+        df['Timestamp'] = pd.to_datetime(df['Timestamp'], errors='coerce')
+
+    # Combine relevant fields into a single text field
+    # (blanks rendered as 'nan' like the original astype(str))
+    cols = [df[c].astype('string[pyarrow]').fillna('nan') for c in df.columns]
+    combined = cols[0]
+    for col in cols[1:]:
+        combined = combined.str.cat(col, sep=' ', na_rep='nan')
+    df['combined_text'] = combined
+    return df
+
+# One persisted detector per app and log schema
+def model_path(schema):
+    digest = hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(MODEL_DIR, f"{MODEL_PREFIX}-{digest}.joblib")
+
+# Fit the feature pipeline + Isolation Forest and persist them, with a fingerprint
+# of the log they were fitted on, for later uploads
+def fit_detector(texts, schema, source):
+    # Hashed TF-IDF vectorization of combined log entries (no vocabulary pass)
+    vectorizer = make_pipeline(HashingVectorizer(n_features=512, alternate_sign=False, binary=True, norm=None, dtype=np.float32), TfidfTransformer())
+    X = vectorizer.fit_transform(texts).astype(np.float32, copy=False)
+
+    # Isolation Forest for unsupervised anomaly detection
+    model = IsolationForest(n_estimators=100, max_samples=min(256, X.shape[0]), contamination=0.05, random_state=42, n_jobs=-1, bootstrap=False)
+    model.fit(X)
+
+    fingerprint = {'schema': schema, 'source': source, 'rows': len(texts)}
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    # Write to a temp file and swap it in, so other sessions never load a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=MODEL_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        joblib.dump((vectorizer, model, fingerprint), tmp_path, compress=3)
+        os.replace(tmp_path, model_path(schema))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    load_detector.clear()
+    score_log.clear()
+    return vectorizer, model
+
+# Persisted (vectorizer, model, fingerprint) for this schema, or None before the first fit
+@st.cache_resource(show_spinner=False)
+def load_detector(schema):
+    path = model_path(schema)
+    if not os.path.exists(path):
+        return None
+    return joblib.load(path)
+
+# Predict in contiguous row chunks on a thread pool, one chunk per core
+def parallel_predict(model, X):
+    n_jobs = max(1, min(os.cpu_count() or 1, X.shape[0]))
+    bounds = np.linspace(0, X.shape[0], n_jobs + 1, dtype=int)
+    parts = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(model.predict)(X[start:stop]) for start, stop in zip(bounds[:-1], bounds[1:])
+    )
+    return np.concatenate(parts)
+
+# Score the log with the persisted detector (predict only, no refit),
+# once per distinct text and broadcast back to every row
+@st.cache_data(show_spinner=False)
+def score_log(csv_bytes, schema):
+    vectorizer, model, _ = load_detector(schema)
+    codes, unique_texts = pd.factorize(prepare_log(csv_bytes)['combined_text'], use_na_sentinel=False)
+    X = vectorizer.transform(unique_texts).astype(np.float32, copy=False)
+    return parallel_predict(model, X)[codes]
+
 uploaded_file = st.file_uploader("📂 Upload CSV File", type="csv")
 
 if uploaded_file is not None:
     try:
-        df = pd.read_csv(uploaded_file)
+        csv_bytes = uploaded_file.getvalue()
+        df = load_log(csv_bytes)
+        schema = {'columns': list(df.columns)}
         st.subheader("🔍 Raw Audit Log Preview")
         st.dataframe(df.head(20))
 
-        # Normalize timestamps
-        if 'Timestamp' in df.columns:
-            df['Timestamp'] = pd.to_datetime(df['Timestamp'], errors='coerce')
-
-        # Combine relevant fields into a single text field
-        df['combined_text'] = df.astype(str).agg(' '.join, axis=1)
+        # Combined text per log entry (cached across reruns)
+        df = prepare_log(csv_bytes)
 
-        # TF-IDF vectorization of combined log entries
-        vectorizer = TfidfVectorizer(max_features=300)
-        X = vectorizer.fit_transform(df['combined_text'])
+        # Reuse the model persisted for this column layout; fit it on first use or on refit
+        detector = load_detector(schema)
+        refit = st.button("🔁 Refit model on this log")
+        if refit or detector is None:
+            fit_detector(df['combined_text'], schema, uploaded_file.name)
+            detector = load_detector(schema)
 
-        # Isolation Forest for unsupervised anomaly detection
-        model = IsolationForest(n_estimators=100, contamination=0.05, random_state=42)
-        preds = model.fit_predict(X)
+        fitted = detector[2]
+        if (fitted['source'], fitted['rows']) == (uploaded_file.name, len(df)):
+            st.caption(f"Anomaly scores from the model fitted on this log (`{fitted['source']}`, {fitted['rows']} rows).")
+        else:
+            st.warning(f"Anomaly scores come from the model fitted on `{fitted['source']}` ({fitted['rows']} rows), not on this log. Use Refit to fit on this log.")
+        preds = score_log(csv_bytes, schema)
         df['Anomaly'] = preds
 
         # Filter anomalies